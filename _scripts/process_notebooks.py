@@ -8,23 +8,40 @@
     * Solution blocks.
 * Write notebooks to output directory.
 * Write JSON jupyterlite file.
+
+Notebooks unchanged since the last run into the same output directory are
+not processed again; the record of the last run goes in a hidden file next
+to the output directory (e.g. ``_build/.jl.process_cache.json`` for output
+directory ``_build/jl``), to keep it out of the JupyterLite contents.  The
+Makefile ``jl`` target clears the output directory first, so always
+processes all notebooks.
 """
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
+from functools import partial
+import json
+import os
 from pathlib import Path
 import re
 from urllib.parse import quote as urlquote, urlparse
 
-import docutils.core as duc
-import docutils.nodes as dun
-from docutils.utils import Reporter
 from sphinx.util.matching import get_matching_files
-from myst_parser.docutils_ import Parser
 import yaml
-
-_END_DIV_RE = re.compile(r'^\s*(:::+|```+|~~~+)\s*$')
+import nbformat
+from nbformat.v4.rwbase import split_lines, strip_transient
 import jupytext
+from jupytext.formats import long_form_one_format
+from traitlets.log import get_logger
+
+# Optional fast ``.ipynb`` writing; fall back to ``jupytext.write`` if orjson,
+# or the (internal) Jupytext function we need, is not available.
+try:
+    import orjson
+    from jupytext.jupytext import drop_text_representation_metadata
+except ImportError:
+    orjson = None
 
 _JL_JSON_FMT = r'''\
 {{
@@ -35,6 +52,10 @@ _JL_JSON_FMT = r'''\
 }}
 '''
 
+# Suffix for hidden file, next to output directory, recording sources for
+# processed notebooks.
+_CACHE_SUFFIX = '.process_cache.json'
+
 _DIV_RE = r'\s*(:::+|```+|~~~+)\s*'
 
 
@@ -46,31 +67,60 @@ _ADM_HEADER = re.compile(
     ''', flags=re.VERBOSE)
 
 
-_EX_SOL_MARKER = re.compile(
-    rf'''
-    (?P<newlines>\n*)
-    {_DIV_RE}
+def _marker_div(directive, div_name):
+    """ Pattern for empty div with `directive`, allowing attribute lines
+    """
+    return rf'''
+    \s*(?P<{div_name}>:::+|```+|~~~+)\s*
     \{{\s*
-    (?P<ex_sol>exercise|solution)-
-    (?P<st_end>start|end)
+    {directive}
     \s*\}}
     \s*
-    (?P<suffix>\S+)?\s*
+    (?:\S+)?\s*
     \n
-    (?P<attrs>\s*:\S+: \s* \S+\s*\n)*
+    (?:\s*:\S+: \s* \S+\s*\n)*
     \n*
-    \s*(\2)\s*
+    \s*(?P={div_name})\s*
     \n
+    '''
+
+
+_EX_SOL_MARKER = re.compile(
+    rf'''
+    (?P<newlines>\n*)
+    {_marker_div(r"(?P<ex_sol>exercise|solution)-(?P<st_end>start|end)",
+                 "div")}
     ''',
     flags=re.VERBOSE)
 
 
-_SOL_MARKED = re.compile(
-    r'''
+# Solution start marker through to solution end marker.  Markers may be
+# solution divs or HTML comments, in any combination.
+_SOL_BLOCK = rf'''
+    (?:
+    \n*
+    {_marker_div("solution-start", "sol_start_div")}
+    |
     \n?
     <!--\sstart-solution\s-->\n
+    )
     .*?
+    (?:
+    {_marker_div("solution-end", "sol_end_div")}
+    |
     <!--\send-solution\s-->\n?
+    )
+    '''
+
+
+# Solution blocks, and exercise / solution markers, for a single
+# substitution pass over the notebook text.  Solution blocks come first so
+# they take precedence over their own start marker.
+_MARKERS = re.compile(
+    rf'''
+    (?P<sol_block>{_SOL_BLOCK})
+    |
+    (?P<ex_sol_marker>{_EX_SOL_MARKER.pattern})
     ''',
     flags=re.VERBOSE | re.MULTILINE | re.DOTALL)
 
@@ -78,26 +128,42 @@ _SOL_MARKED = re.compile(
 _END_DIV_RE = re.compile(rf'^{_DIV_RE}$')
 
 
-# https://myst-parser.readthedocs.io/en/latest/syntax/optional.html#syntax-extensions
-MYST_EXTENSIONS = [
-    "amsmath",
-    "attrs_inline",
-    "colon_fence",
-    "deflist",
-    "dollarmath",
-    "fieldlist",
-    "html_admonition",
-    "html_image",
-    "linkify",
-    "replacements",
-    "smartquotes",
-    "strikethrough",
-    "substitution",
-    "tasklist",
-]
-
-
-def _replace_markers(m):
+# Any fence line, with or without info string.
+_FENCE_RE = re.compile(rf'^{_DIV_RE}(?P<info>.*?)\s*$')
+
+
+# Start of list item, up to item content.
+_LIST_ITEM = re.compile(r'^ *(?:[-+*]|\d{1,9}[.)]) {1,4}(?=\S)')
+
+
+# Docutils directives giving admonition nodes.
+_ADM_TYPES = ('admonition', 'attention', 'caution', 'danger', 'error',
+              'hint', 'important', 'note', 'tip', 'warning')
+
+
+# Cheap check for any admonition directive in notebook text.
+_HAS_ADM = re.compile(rf'\{{\s*(?:{"|".join(_ADM_TYPES)})\s*\}}')
+
+
+# Substrings present in text containing anything for _MARKERS to replace.
+_MARKER_STRS = ('exercise-', 'solution-', 'start-solution')
+
+
+# Bound methods of compiled patterns, for use in loops.
+_MARKERS_SUB = _MARKERS.sub
+_ADM_HEADER_MATCH = _ADM_HEADER.match
+_FENCE_MATCH = _FENCE_RE.match
+_LIST_ITEM_MATCH = _LIST_ITEM.match
+_HAS_ADM_SEARCH = _HAS_ADM.search
+
+
+# Jupytext format for notebook text; set extension per notebook.
+_MYST_FMT_BASE = long_form_one_format('myst')
+
+
+def _replace_markers(m, sol_txt):
+    if m.lastgroup != 'ex_sol_marker':
+        return sol_txt
     st_end = m['st_end']
     if m['ex_sol'] == 'exercise':
         return (f"{m['newlines']}**{st_end.capitalize()} "
@@ -105,39 +171,85 @@ def _replace_markers(m):
     return f'\n<!-- {st_end}-solution -->\n'
 
 
-def get_admonition_lines(nb_text):
-    parser = Parser()
-    doc = duc.publish_doctree(
-        source=nb_text,
-        settings_overrides={
-            "myst_enable_extensions": MYST_EXTENSIONS,
-            'report_level': Reporter.SEVERE_LEVEL,
-        },
-        parser=parser)
-    lines = nb_text.splitlines()
-    n_lines = len(lines)
-    admonition_lines = []
-    for admonition in doc.findall(dun.Admonition):
-        start_line = admonition.line - 1
-        following = list(admonition.findall(include_self=False,
-                                            descend=False,
-                                            ascend=True))
-        last_line = following[0].line - 2 if following else n_lines - 1
-        for end_line in range(last_line, start_line + 1, -1):
-            if _END_DIV_RE.match(lines[end_line]):
+def _indent(line):
+    return len(line) - len(line.lstrip(' '))
+
+
+def _is_closing(m, line, fence, base):
+    """ True if fence match `m` for `line` closes `fence` in block at `base`
+
+    Closing fence is bare, same character, at least as long, and not indented
+    as code.
+    """
+    close = m.group(1)
+    return (not m['info'] and close[0] == fence[0]
+            and len(close) >= len(fence) and _indent(line) - base < 4)
+
+
+def _iter_admonitions(lines, start=0, stop=None, base=0):
+    """ Yield ``(start_line, end_line, header_match)`` for admonition blocks
+
+    Scan `lines` from `start` up to `stop`, where `base` is the indent of the
+    containing block.  As for Markdown, a fenced block ends at the first
+    closing fence, whatever it contains.  We then scan the bodies of
+    ``{directive}`` blocks for nested blocks; bodies of code blocks are
+    literal.
+    """
+    stop = len(lines) if stop is None else stop
+    # Indent of list item content, if in list item; fences indented by four
+    # or more from here are indented code.
+    item_indent = base
+    prev_blank = False
+    i = start
+    while i < stop:
+        line = lines[i]
+        i += 1
+        if not line.strip():
+            prev_blank = True
+            continue
+        indent = _indent(line)
+        list_m = _LIST_ITEM_MATCH(line)
+        if list_m:
+            item_indent = list_m.end()
+        elif prev_blank and indent < item_indent:  # End of list.
+            item_indent = base
+        prev_blank = False
+        m = _FENCE_MATCH(line)
+        if not m or indent - item_indent >= 4:
+            continue
+        fence, first = m.group(1), i - 1
+        for last in range(i, stop):
+            close_m = _FENCE_MATCH(lines[last])
+            if close_m and _is_closing(close_m, lines[last], fence,
+                                       item_indent):
                 break
-        else:
-            raise ValueError('Could not find end div')
-        admonition_lines.append((start_line, end_line))
-    return admonition_lines
+        else:  # Unclosed block runs to end of container.
+            last = stop
+        if m['info'].startswith('{'):
+            yield from _iter_admonitions(lines, i, last, indent)
+        adm_m = _ADM_HEADER_MATCH(line)
+        if adm_m and adm_m['ad_type'] in _ADM_TYPES:
+            if last == stop:
+                raise ValueError('Could not find end div')
+            yield first, last, adm_m
+        i = last + 1
 
 
-_ADM_HEADER = re.compile(
-    r'''
-    ^\s*(:::+|```+|~~~+)\s*
-    \{\s*(?P<ad_type>\S+)\s*\}\s*
-    (?P<ad_title>.*)\s*$
-    ''', flags=re.VERBOSE)
+def get_admonition_lines(nb_text):
+    """ Find line indices of admonition start and end fences in `nb_text`
+
+    Parameters
+    ----------
+    nb_text : str
+        Notebook text.
+
+    Returns
+    -------
+    admonition_lines : list
+        List of ``(start_line, end_line)`` tuples, in order of end line.
+    """
+    return [(first, last) for first, last, _
+            in _iter_admonitions(nb_text.splitlines())]
 
 
 _LABEL = re.compile(
@@ -145,17 +257,24 @@ _LABEL = re.compile(
     flags=re.MULTILINE)
 
 
+def _eol(line):
+    """ Line ending of `line`, or empty string if none
+    """
+    return line[len(line.rstrip('\r\n')):]
+
+
 def process_admonitions(nb_text):
-    lines = nb_text.splitlines()
-    for first, last in get_admonition_lines(nb_text):
-        m = _ADM_HEADER.match(lines[first])
-        if not m:
-            raise ValueError(f"Cannot get match from {lines[first]}")
-        ad_type, ad_title = m['ad_type'], m['ad_title']
+    if not _HAS_ADM_SEARCH(nb_text):  # Skip line scan.
+        return nb_text
+    # Keep line endings, to preserve final newline.
+    lines = nb_text.splitlines(keepends=True)
+    # Rewrite lines as we scan; the scan has passed both lines at each yield.
+    for first, last, m in _iter_admonitions(lines):
+        ad_type, ad_title = m['ad_type'], m['ad_title'].rstrip()
         suffix = f': {ad_title}' if ad_title else ''
-        lines[first] = f"**Start of {ad_type}{suffix}**"
-        lines[last] = f"**End of {ad_type}**"
-    return '\n'.join(lines)
+        lines[first] = f"**Start of {ad_type}{suffix}**{_eol(lines[first])}"
+        lines[last] = f"**End of {ad_type}**{_eol(lines[last])}"
+    return ''.join(lines)
 
 
 def process_labels(nb):
@@ -203,16 +322,99 @@ def load_process_nb(nb_path, fmt='myst', url=None):
     link_txt = 'corresponding page'
     page_link = f'[{link_txt}]({url})' if url else link_txt
     nb_path = Path(nb_path)
-    nb_text = nb_path.read_text()
-    nbt1 = _EX_SOL_MARKER.sub(_replace_markers, nb_text)
-    nbt2 = _SOL_MARKED.sub(f'\n**See the {page_link} for solution**\n\n', nbt1)
-    nbt3 = process_admonitions(nbt2)
-    nb = jupytext.reads(nbt3,
-                        fmt={'format_name': 'myst',
-                             'extension': nb_path.suffix})
+    # Decode bytes, translating newlines as for reading in text mode.
+    nb_text = (nb_path.read_bytes().decode('utf-8')
+               .replace('\r\n', '\n').replace('\r', '\n'))
+    sol_txt = f'\n**See the {page_link} for solution**\n\n'
+    nbt1 = (_MARKERS_SUB(partial(_replace_markers, sol_txt=sol_txt), nb_text)
+            if any(s in nb_text for s in _MARKER_STRS) else nb_text)
+    nbt2 = process_admonitions(nbt1)
+    nb = jupytext.reads(nbt2,
+                        fmt={**_MYST_FMT_BASE, 'extension': nb_path.suffix})
     return process_labels(nb)
 
 
+def _write_ipynb(nb, out_path):
+    """ Write notebook `nb` to ``.ipynb`` file `out_path` using `orjson`
+
+    As for ``jupytext.write``, but with faster JSON serialization.  Modifies
+    cells of `nb` in place.
+    """
+    nb = drop_text_representation_metadata(nb)
+    # As for nbformat.writes, log rather than raise validation errors.
+    try:
+        nbformat.validate(nb)
+    except nbformat.ValidationError as e:
+        get_logger().error("Notebook JSON is invalid: %s", e)
+    nb = strip_transient(split_lines(nb))
+    Path(out_path).write_bytes(
+        orjson.dumps(nb, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+        + b'\n')
+
+
+def _process_one(rel_path, input_dir, output_dir, base_path,
+                 nb_fmt, kernel_name, kernel_dname, out_nb_suffix):
+    """ Process and write notebook at `rel_path` relative to `input_dir`
+
+    Top-level function so it can be pickled for use in a process pool.
+    """
+    print(f'Processing {rel_path}')
+    nb_url = base_path + '/' + urlquote(
+        rel_path.with_suffix('.html').as_posix())
+    nb = load_process_nb(input_dir / rel_path, nb_fmt, nb_url)
+    nb['metadata']['kernelspec'] = {
+        'name': kernel_name,
+        'display_name': kernel_dname}
+    out_path = (output_dir / rel_path).with_suffix(out_nb_suffix)
+    if out_nb_suffix == '.ipynb' and orjson is not None:
+        _write_ipynb(nb, out_path)
+    else:
+        jupytext.write(nb, out_path)
+
+
+def _source_key(path):
+    """ Key for notebook source at `path`, changing if the file changes
+    """
+    st = Path(path).stat()
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _load_cache(cache_path):
+    """ Load cache of source keys from previous run, or empty dict
+    """
+    try:
+        return json.loads(Path(cache_path).read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _output_path(output_root, rel_path, suffix):
+    """ Output path for `rel_path` with `suffix`, or None if invalid
+
+    None if the path would not be within `output_root`.  Protects against bad
+    paths in the cache file.
+    """
+    try:
+        out_path = (output_root / rel_path).with_suffix(suffix).resolve()
+    except ValueError:  # Invalid suffix.
+        return None
+    return out_path if output_root in out_path.parents else None
+
+
+def _process_all(rel_paths, **kwargs):
+    """ Run `_process_one` on `rel_paths`, in parallel
+    """
+    # Notebooks are independent, so process them in parallel.
+    worker = partial(_process_one, **kwargs)
+    n_workers = min(os.cpu_count() or 1, len(rel_paths))
+    # Send notebooks to workers in batches, to cut per-task overhead, but
+    # with several batches per worker, to balance load.
+    chunksize = max(1, len(rel_paths) // (n_workers * 4))
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        # Consume iterator to raise any errors from workers.
+        list(executor.map(worker, rel_paths, chunksize=chunksize))
+
+
 def process_notebooks(config, output_dir,
                       in_nb_suffix='.Rmd',
                       nb_fmt='myst',
@@ -221,22 +423,52 @@ def process_notebooks(config, output_dir,
                       out_nb_suffix='.ipynb'
                      ):
     input_dir = Path(config['input_dir'])
-    # Use sphinx utiliti to find not-excluded files.
-    for fn in get_matching_files(input_dir,
-                                 exclude_patterns=config['exclude_patterns']):
-        rel_path = Path(fn)
-        if not rel_path.suffix == in_nb_suffix:
-            continue
-        print(f'Processing {rel_path}')
-        nb_url = config['base_path'] + '/' + urlquote(
-            rel_path.with_suffix('.html').as_posix())
-        nb = load_process_nb(input_dir / rel_path, nb_fmt, nb_url)
-        nb['metadata']['kernelspec'] = {
-            'name': kernel_name,
-            'display_name': kernel_dname}
-        out_path = (output_dir / rel_path).with_suffix(out_nb_suffix)
-        out_path.parent.mkdir(exist_ok=True, parents=True)
-        jupytext.write(nb, out_path)
+    output_dir = Path(output_dir)
+    # Use sphinx utility to find not-excluded notebook files.
+    rel_paths = [Path(fn) for fn in get_matching_files(
+        input_dir,
+        include_patterns=['**' + in_nb_suffix],
+        exclude_patterns=config['exclude_patterns'])]
+    # Skip notebooks unchanged since the last run with the same settings,
+    # where the output is still present.
+    output_root = output_dir.resolve()
+    cache_path = output_root.parent / f'.{output_root.name}{_CACHE_SUFFIX}'
+    settings = {'base_path': config['base_path'],
+                'nb_fmt': nb_fmt,
+                'kernel_name': kernel_name,
+                'kernel_dname': kernel_dname,
+                'out_nb_suffix': out_nb_suffix,
+                'script_key': _source_key(__file__)}
+    cache = _load_cache(cache_path)
+    old_settings = cache.get('settings', {})
+    old_keys = cache.get('sources', {})
+    keys = {p.as_posix(): _source_key(input_dir / p) for p in rel_paths}
+    # Remove outputs for sources deleted, renamed or excluded since last run,
+    # or all previous outputs, if the output suffix has changed.
+    old_suffix = old_settings.get('out_nb_suffix', out_nb_suffix)
+    for rel_path in (old_keys if old_suffix != out_nb_suffix
+                     else old_keys.keys() - keys.keys()):
+        stale_path = _output_path(output_root, rel_path, old_suffix)
+        if stale_path is not None:
+            stale_path.unlink(missing_ok=True)
+    if old_settings != settings:
+        old_keys = {}
+    rel_paths = [p for p in rel_paths
+                 if old_keys.get(p.as_posix()) != keys[p.as_posix()]
+                 or not (output_dir / p).with_suffix(out_nb_suffix).is_file()]
+    output_dir.mkdir(exist_ok=True, parents=True)
+    for out_dir in {(output_dir / p).parent for p in rel_paths}:
+        out_dir.mkdir(exist_ok=True, parents=True)
+    if rel_paths:
+        _process_all(rel_paths,
+                     input_dir=input_dir,
+                     output_dir=output_dir,
+                     base_path=config['base_path'],
+                     nb_fmt=nb_fmt,
+                     kernel_name=kernel_name,
+                     kernel_dname=kernel_dname,
+                     out_nb_suffix=out_nb_suffix)
+    cache_path.write_text(json.dumps({'settings': settings, 'sources': keys}))
 
 
 def get_parser():
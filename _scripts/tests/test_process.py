@@ -1,6 +1,7 @@
 """ Test notebook parsing
 """
 
+import json
 import sys
 from pathlib import Path
 
@@ -53,3 +54,137 @@ def test_admonition_finding(nb_path):
     for first, last in ad_lines:
         assert pn._ADM_HEADER.match(nb_lines[first])
         assert pn._END_DIV_RE.match(nb_lines[last])
+
+
+def test_mixed_solution_markers(tmp_path):
+    sol_start = '::: {solution-start} ex\n:class: dropdown\n:::\n'
+    sol_end = '::: {solution-end}\n:::\n'
+    ex_div = ('::: {exercise-start}\n:label: ex2\n:::\n\nPrompt two.\n\n'
+              '::: {exercise-end}\n:::\n')
+    note = '::: {note} Title\nA note.\n:::\n'
+    for start, end, newline in (
+        (sol_start, '<!-- end-solution -->\n', '\n'),
+        ('<!-- start-solution -->\n', sol_end, '\n'),
+        ('<!-- start-solution -->\n', '<!-- end-solution -->\n', '\r\n'),
+        (sol_start, sol_end, '\r\n')):
+        nb_text = (f'Text.\n\n{start}\nSecret text one.\n\n{end}\n'
+                   f'More text.\n\n{ex_div}\n'
+                   f'{sol_start}\nSecret text two.\n\n'
+                   f'{sol_end}\nEnd text.\n\n{note}')
+        nb_path = tmp_path / 'mixed.md'
+        nb_path.write_bytes(nb_text.replace('\n', newline).encode('utf-8'))
+        out_txt = nb2rmd(pn.load_process_nb(nb_path))
+        out_lines = out_txt.splitlines()
+        assert 'Secret text' not in out_txt
+        assert 'solution -->' not in out_txt
+        assert out_lines.count(
+            '**See the corresponding page for solution**') == 2
+        assert 'Prompt two.' in out_lines
+        assert out_lines.count('**Start of exercise**') == 1
+        assert 'End text.' in out_lines
+        assert '**Start of note: Title**' in out_lines
+
+
+def test_no_admonitions():
+    nb_text = '# A title\n\nSome text, with {math}`x` role.\n'
+    assert pn.process_admonitions(nb_text) == nb_text
+
+
+def test_admonition_newlines():
+    nb_text = 'Text.\n\n::: {note}\n\nA note.\n\n:::\n\nMore text.\n'
+    out_text = pn.process_admonitions(nb_text)
+    assert out_text == ('Text.\n\n**Start of note**\n\nA note.\n\n'
+                        '**End of note**\n\nMore text.\n')
+    nb_text = '::: {note} Title\r\nA note.\r\n:::\r\n'
+    assert pn.process_admonitions(nb_text) == (
+        '**Start of note: Title**\r\nA note.\r\n**End of note**\r\n')
+
+
+def test_nested_admonitions():
+    nb_text = '''\
+:::: {note}
+
+```{python}
+:::
+```
+
+::: {warning}
+Careful.
+:::
+
+::::
+'''
+    assert pn.get_admonition_lines(nb_text) == [(6, 8), (0, 10)]
+    # Admonitions in other directives.
+    for header in ('{container}', '{topic} My topic', '{sidebar} Aside'):
+        nb_text = f':::: {header}\n\n::: {{note}}\nA note.\n:::\n\n::::\n'
+        assert pn.get_admonition_lines(nb_text) == [(2, 4)]
+    # Not in indented code, but may be indented in list items.
+    nb_text = 'Text.\n\n    ::: {note}\n    A note.\n    :::\n\nMore.\n'
+    assert pn.get_admonition_lines(nb_text) == []
+    nb_text = '1. Item.\n\n    ::: {note}\n    A note.\n    :::\n\nMore.\n'
+    assert pn.get_admonition_lines(nb_text) == [(2, 4)]
+    # Unclosed code fence ends with containing admonition.
+    nb_text = '::: {note}\n```python\nx = 1\n:::\n\nText.\n'
+    assert pn.get_admonition_lines(nb_text) == [(0, 3)]
+    with pytest.raises(ValueError):
+        pn.get_admonition_lines(':::{note}\n\nNo end.\n')
+
+
+def test_process_notebooks_cache(tmp_path):
+    in_dir = tmp_path / 'in'
+    in_dir.mkdir()
+    in_path = in_dir / 'eg.Rmd'
+    in_path.write_text(EG1_NB_PATH.read_text())
+    out_dir = tmp_path / 'out'
+    config = {'input_dir': in_dir, 'base_path': '', 'exclude_patterns': []}
+    pn.process_notebooks(config, out_dir)
+    out_path = out_dir / 'eg.ipynb'
+    assert out_path.is_file()
+    # Unchanged source; output not rewritten.
+    out_path.write_text('Placeholder')
+    pn.process_notebooks(config, out_dir)
+    assert out_path.read_text() == 'Placeholder'
+    # Changed source; output rewritten.
+    in_path.write_text(in_path.read_text() + '\nMore text.\n')
+    pn.process_notebooks(config, out_dir)
+    assert 'More text.' in out_path.read_text()
+    # Missing output; output rewritten.
+    out_path.unlink()
+    pn.process_notebooks(config, out_dir)
+    assert out_path.is_file()
+    # Renamed source; old output removed.
+    in_path.rename(in_dir / 'eg_new.Rmd')
+    pn.process_notebooks(config, out_dir)
+    assert not out_path.is_file()
+    assert (out_dir / 'eg_new.ipynb').is_file()
+    # Excluded source; output removed.
+    config['exclude_patterns'] = ['eg_new.Rmd']
+    pn.process_notebooks(config, out_dir)
+    assert not (out_dir / 'eg_new.ipynb').is_file()
+    # Cache kept out of output directory.
+    cache_path = tmp_path / '.out.process_cache.json'
+    assert cache_path.is_file()
+    assert list(out_dir.glob('.*')) == []
+    # Stale paths outside output directory not removed.
+    victim = tmp_path / 'victim.ipynb'
+    victim.write_text('Keep me')
+    cache = json.loads(cache_path.read_text())
+    cache['sources']['../victim.Rmd'] = [0, 0]
+    cache_path.write_text(json.dumps(cache))
+    pn.process_notebooks(config, out_dir)
+    assert victim.read_text() == 'Keep me'
+
+
+@pytest.mark.skipif(pn.orjson is None, reason='Needs orjson')
+def test_write_ipynb(tmp_path):
+    nb = pn.load_process_nb(EG1_NB_PATH)
+    jt_path = tmp_path / 'jt.ipynb'
+    jupytext.write(nb, jt_path)
+    oj_path = tmp_path / 'oj.ipynb'
+    pn._write_ipynb(nb, oj_path)
+    assert json.loads(oj_path.read_text()) == json.loads(jt_path.read_text())
+    # Invalid notebooks written, as for jupytext.write.
+    nb['cells'][0]['invalid_key'] = 1
+    pn._write_ipynb(nb, oj_path)
+    assert 'invalid_key' in json.loads(oj_path.read_text())['cells'][0]
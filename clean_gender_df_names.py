@@ -1,25 +1,20 @@
 """ A crude way of getting the solution to the string exercise
 """
 
-def get_cleaned(name_series):
+# A translation table.  The keys are the original characters, the values are
+# the replacement strings (empty strings to remove the character).
+_TRANSLATE = str.maketrans({" ": "_",
+                            "(": "",
+                            ")": "",
+                            ",": "",
+                            ".": "",
+                            "-": "_"})
 
-    # Copy the given Series.
-    clean_mat_mort_names_solution = name_series.copy()
 
-    # A dictionary of values. The `.keys()` are the original strings, the `.values()`
-    # are the replacement strings
-    replace_dict = {" ": "_",
-                    "(": "",
-                    ")": "",
-                    ",": "",
-                    ".": "",
-                    "-": "_"}
+def get_cleaned(name_series):
 
-    # Loop through the keys and values
-    for to_replace, replace in zip(replace_dict.keys(), 
-                                   replace_dict.values()):
-        # Make the replacements.
-        clean_mat_mort_names_solution = (clean_mat_mort_names_solution
-                                         .str.replace(to_replace, replace))
+    # Make all the replacements in one pass over each string.  This returns a
+    # new Series, so there is no need to copy `name_series`.
+    clean_mat_mort_names_solution = name_series.str.translate(_TRANSLATE)
     # Remove capitalization
     return clean_mat_mort_names_solution.str.lower()